@@ -2,6 +2,7 @@
 Configurazione centralizzata
 """
 import os
+from functools import lru_cache
 from pydantic_settings import BaseSettings
 from typing import Optional
 
@@ -29,4 +30,7 @@ class Settings(BaseSettings):
         env_file = ".env"
         case_sensitive = False
 
-settings = Settings()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Istanza Settings unica, creata al primo utilizzo"""
+    return Settings()
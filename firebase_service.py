@@ -2,10 +2,14 @@
 Firebase Service per MAVKUS AI
 """
 import os
+import random
 import logging
+import threading
 from datetime import datetime
-from typing import Dict, Optional, List, Any
+from functools import lru_cache
+from typing import Dict, Optional, List, Any, Tuple
 
+from cachetools import TTLCache
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv
 
@@ -19,39 +23,66 @@ logger = logging.getLogger("FirebaseService")
 # =========================
 # INIZIALIZZAZIONE FIREBASE
 # =========================
-try:
-    import firebase_admin
-    from firebase_admin import credentials, firestore
-    
-    # Verifica variabili ambiente
-    required_vars = ["FIREBASE_PROJECT_ID", "FIREBASE_PRIVATE_KEY", "FIREBASE_CLIENT_EMAIL"]
-    missing_vars = [var for var in required_vars if not os.getenv(var)]
-    
-    if missing_vars:
-        logger.error(f"❌ Variabili Firebase mancanti: {missing_vars}")
-        raise ValueError(f"Variabili Firebase mancanti: {missing_vars}")
-    
-    # Configura credenziali
-    firebase_config = {
-        "type": "service_account",
-        "project_id": os.getenv("FIREBASE_PROJECT_ID"),
-        "private_key": os.getenv("FIREBASE_PRIVATE_KEY").replace("\\n", "\n"),
-        "client_email": os.getenv("FIREBASE_CLIENT_EMAIL"),
-        "token_uri": "https://oauth2.googleapis.com/token"
-    }
-    
-    if not firebase_admin._apps:
-        cred = credentials.Certificate(firebase_config)
-        firebase_admin.initialize_app(cred)
-    
-    db = firestore.client()
-    FIREBASE_AVAILABLE = True
-    logger.info("✅ Firebase inizializzato correttamente")
-    
-except Exception as e:
-    logger.error(f"❌ Errore inizializzazione Firebase: {e}")
-    FIREBASE_AVAILABLE = False
-    db = None
+# Import differiti al primo utilizzo (riduce il cold start)
+firestore = None
+NotFound = None
+InvalidArgument = None
+db = None
+adb = None
+FIREBASE_AVAILABLE = False
+_firebase_initialized = False
+
+def _init_firebase():
+    """Importa e inizializza Firebase una sola volta"""
+    global firestore, NotFound, InvalidArgument, db, adb, FIREBASE_AVAILABLE, _firebase_initialized
+    if _firebase_initialized:
+        return db
+    _firebase_initialized = True
+    
+    try:
+        import firebase_admin
+        from firebase_admin import credentials
+        from firebase_admin import firestore as firestore_mod
+        from firebase_admin import firestore_async
+        from google.api_core.exceptions import NotFound as not_found_exc
+        from google.api_core.exceptions import InvalidArgument as invalid_argument_exc
+        
+        # Verifica variabili ambiente
+        required_vars = ["FIREBASE_PROJECT_ID", "FIREBASE_PRIVATE_KEY", "FIREBASE_CLIENT_EMAIL"]
+        missing_vars = [var for var in required_vars if not os.getenv(var)]
+        
+        if missing_vars:
+            logger.error(f"❌ Variabili Firebase mancanti: {missing_vars}")
+            raise ValueError(f"Variabili Firebase mancanti: {missing_vars}")
+        
+        # Configura credenziali
+        firebase_config = {
+            "type": "service_account",
+            "project_id": os.getenv("FIREBASE_PROJECT_ID"),
+            "private_key": os.getenv("FIREBASE_PRIVATE_KEY").replace("\\n", "\n"),
+            "client_email": os.getenv("FIREBASE_CLIENT_EMAIL"),
+            "token_uri": "https://oauth2.googleapis.com/token"
+        }
+        
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(firebase_config)
+            firebase_admin.initialize_app(cred)
+        
+        firestore = firestore_mod
+        NotFound = not_found_exc
+        InvalidArgument = invalid_argument_exc
+        db = firestore.client()
+        adb = firestore_async.client()
+        FIREBASE_AVAILABLE = True
+        logger.info("✅ Firebase inizializzato correttamente")
+        
+    except Exception as e:
+        logger.error(f"❌ Errore inizializzazione Firebase: {e}")
+        FIREBASE_AVAILABLE = False
+        db = None
+        adb = None
+    
+    return db
 
 # =========================
 # SERVIZIO DI CRITTAZIONE
@@ -82,16 +113,182 @@ class EncryptionService:
         if not value:
             return ""
         return self.cipher.decrypt(value.encode()).decode()
+    
+    def bulk_encrypt(self, items: Dict[str, Optional[str]]) -> Dict[str, bytes]:
+        """Cripta più valori, saltando quelli vuoti (token come bytes)"""
+        encrypt = self.cipher.encrypt
+        return {k: encrypt(v.encode()) for k, v in items.items() if v}
+    
+    def bulk_decrypt(self, items: Dict[str, Any]) -> Dict[str, str]:
+        """Decripta più token (bytes o stringhe legacy)"""
+        decrypt = self.cipher.decrypt
+        return {k: decrypt(v).decode() if v else "" for k, v in items.items()}
 
 # =========================
 # SERVIZIO FIREBASE PRINCIPALE
 # =========================
 class FirebaseService:
+    # Campi restituiti nell'elenco conversazioni (senza i messaggi)
+    CONVERSATION_LIST_FIELDS = ["title", "created_at", "message_count", "user_id"]
+    # Shard del contatore conversazioni (evita la contesa sul documento utente)
+    COUNTER_SHARDS = 10
+    # Limite operazioni per WriteBatch Firestore
+    MAX_BATCH_OPS = 500
+    
     def __init__(self):
+        db = _init_firebase()
         self.available = FIREBASE_AVAILABLE
         self.crypto = EncryptionService()
+        
+        # Client Firestore unico (thread-safe, multiplexa le chiamate gRPC)
+        self.db = db
+        self.users = db.collection("users") if db else None
+        # Client async per gli handler FastAPI (non blocca l'event loop)
+        self.adb = adb
+        self.ausers = adb.collection("users") if adb else None
+        # Cache dei DocumentReference per utente
+        self._user_ref = lru_cache(maxsize=4096)(self._build_user_ref)
+        self._auser_ref = lru_cache(maxsize=4096)(self._build_auser_ref)
+        # Cache API keys decriptate (cambiano raramente)
+        self._keys_cache = TTLCache(maxsize=10_000, ttl=300)
+        # Generazione per utente, incrementata ad ogni invalidazione: una lettura
+        # iniziata prima di un salvataggio non rimette in cache le chiavi vecchie
+        self._keys_generations: Dict[str, int] = {}
+        self._keys_lock = threading.RLock()
         logger.info(f"📊 Firebase Service: {'✅ Disponibile' if self.available else '❌ Non disponibile'}")
     
+    def _build_user_ref(self, user_id: str):
+        """Costruisce il riferimento al documento utente"""
+        return self.users.document(user_id)
+    
+    def _build_auser_ref(self, user_id: str):
+        """Costruisce il riferimento async al documento utente"""
+        return self.ausers.document(user_id)
+    
+    # ---------- DATI CONDIVISI SYNC/ASYNC ----------
+    @staticmethod
+    def _profile_updates(display_name: Optional[str], photo_url: Optional[str]) -> Dict[str, Any]:
+        """Campi aggiornati ad ogni login"""
+        updates = {
+            "last_login": firestore.SERVER_TIMESTAMP,
+            "updated_at": firestore.SERVER_TIMESTAMP
+        }
+        if display_name:
+            updates["display_name"] = display_name
+        if photo_url:
+            updates["photo_url"] = photo_url
+        return updates
+    
+    @staticmethod
+    def _new_profile(user_id: str, email: str, display_name: Optional[str], photo_url: Optional[str]) -> Dict[str, Any]:
+        """Profilo completo per un nuovo utente"""
+        return {
+            "user_id": user_id,
+            "email": email,
+            "display_name": display_name or "",
+            "photo_url": photo_url or "",
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "last_login": firestore.SERVER_TIMESTAMP,
+            "total_conversations": 0,
+            "total_tokens_used": 0,
+            "plan": "free",
+            "api_keys_configured": False,
+            "updated_at": firestore.SERVER_TIMESTAMP
+        }
+    
+    def _api_keys_update(self, api_keys: Dict[str, str]) -> Dict[str, Any]:
+        """Cripta le API keys presenti e prepara l'aggiornamento"""
+        encrypted_keys = self.crypto.bulk_encrypt({
+            "groq": api_keys.get("groq_api_key"),
+            "gemini": api_keys.get("gemini_api_key")
+        })
+        return {
+            "api_keys": encrypted_keys,
+            "api_keys_configured": len(encrypted_keys) > 0,
+            "updated_at": firestore.SERVER_TIMESTAMP
+        }
+    
+    def _decrypt_api_keys(self, data: Dict[str, Any]) -> Dict[str, str]:
+        """Decripta le API keys di un documento utente"""
+        return {
+            f"{name}_api_key": value
+            for name, value in self.crypto.bulk_decrypt(data.get("api_keys", {})).items()
+            if name in ("groq", "gemini")
+        }
+    
+    def _cached_api_keys(self, user_id: str) -> Optional[Dict[str, str]]:
+        """API keys in cache, se presenti"""
+        with self._keys_lock:
+            return self._keys_cache.get(user_id)
+    
+    def _keys_generation(self, user_id: str) -> int:
+        """Generazione corrente delle API keys (da leggere prima di Firestore)"""
+        with self._keys_lock:
+            return self._keys_generations.get(user_id, 0)
+    
+    def _cache_api_keys(self, user_id: str, keys: Dict[str, str], generation: int):
+        """Memorizza API keys decriptate, se nel frattempo non sono state invalidate"""
+        with self._keys_lock:
+            if self._keys_generations.get(user_id, 0) == generation:
+                self._keys_cache[user_id] = keys
+    
+    def invalidate_api_keys(self, user_id: str):
+        """Rimuove le API keys dalla cache (da chiamare dopo ogni scrittura delle chiavi)"""
+        with self._keys_lock:
+            self._keys_cache.pop(user_id, None)
+            self._keys_generations[user_id] = self._keys_generations.get(user_id, 0) + 1
+    
+    @staticmethod
+    def _prepare_conversation(user_id: str, conv_ref, conversation_data: Dict) -> Dict:
+        """Aggiungi metadati alla conversazione"""
+        conversation_data["id"] = conv_ref.id
+        # Stringa ISO UTC come i documenti esistenti: l'elenco è ordinato su
+        # created_at e Firestore ordina i timestamp prima delle stringhe
+        conversation_data["created_at"] = datetime.utcnow().isoformat()
+        conversation_data["user_id"] = user_id
+        return conversation_data
+    
+    def _counter_shard(self, user_ref):
+        """Shard casuale del contatore conversazioni"""
+        return user_ref.collection("counters").document(f"shard_{random.randrange(self.COUNTER_SHARDS)}")
+    
+    @staticmethod
+    def _conversation_counter(delta: int) -> Dict[str, Any]:
+        """Aggiornamento contatore conversazioni (su shard)"""
+        return {"total_conversations": firestore.Increment(delta)}
+    
+    def _fill_conversation_batch(self, batch, items: List[Tuple[str, Optional[str], Dict]], user_ref) -> List[str]:
+        """Accoda conversazioni e contatori (uno per utente) nel batch"""
+        ids, counts = [], {}
+        for user_id, conversation_id, conversation_data in items:
+            conv_ref = user_ref(user_id).collection("conversations").document(conversation_id)
+            batch.set(conv_ref, self._prepare_conversation(user_id, conv_ref, conversation_data))
+            counts[user_id] = counts.get(user_id, 0) + 1
+            ids.append(conv_ref.id)
+        for user_id, delta in counts.items():
+            batch.set(self._counter_shard(user_ref(user_id)), self._conversation_counter(delta), merge=True)
+        return ids
+    
+    def _batch_chunks(self, items: List) -> List[List]:
+        """Gruppi di item entro il limite del batch (max 2 operazioni per item)"""
+        size = self.MAX_BATCH_OPS // 2
+        return [items[i:i + size] for i in range(0, len(items), size)]
+    
+    @staticmethod
+    def _count_from_shards(user_data: Optional[Dict], shard_docs) -> int:
+        """Valore storico sul profilo + somma degli shard"""
+        total = (user_data or {}).get("total_conversations", 0)
+        for doc in shard_docs:
+            total += (doc.to_dict() or {}).get("total_conversations", 0)
+        return total
+    
+    @staticmethod
+    def _with_id(doc) -> Dict:
+        """Dati del documento con il suo id"""
+        data = doc.to_dict()
+        data["id"] = doc.id
+        return data
+    
     # ---------- GESTIONE UTENTI ----------
     def create_user_profile(self, user_id: str, email: str, display_name: str = None, photo_url: str = None) -> Dict[str, Any]:
         """Crea o aggiorna profilo utente"""
@@ -99,37 +296,15 @@ class FirebaseService:
             return {"success": False, "error": "firebase_unavailable"}
         
         try:
-            user_ref = db.collection("users").document(user_id)
-            now = datetime.utcnow().isoformat()
-            
-            user_data = {
-                "user_id": user_id,
-                "email": email,
-                "display_name": display_name or "",
-                "photo_url": photo_url or "",
-                "created_at": now,
-                "last_login": now,
-                "total_conversations": 0,
-                "total_tokens_used": 0,
-                "plan": "free",
-                "api_keys_configured": False,
-                "updated_at": now
-            }
-            
-            # Verifica se esiste già
-            existing = user_ref.get()
-            if existing.exists:
-                # Aggiorna solo alcuni campi
-                user_ref.update({
-                    "last_login": now,
-                    "display_name": display_name or existing.to_dict().get("display_name", ""),
-                    "photo_url": photo_url or existing.to_dict().get("photo_url", ""),
-                    "updated_at": now
-                })
+            user_ref = self._user_ref(user_id)
+            
+            # Aggiorna solo alcuni campi, senza lettura preliminare
+            try:
+                user_ref.update(self._profile_updates(display_name, photo_url))
                 action = "aggiornato"
-            else:
+            except NotFound:
                 # Crea nuovo
-                user_ref.set(user_data)
+                user_ref.set(self._new_profile(user_id, email, display_name, photo_url))
                 action = "creato"
             
             logger.info(f"👤 Profilo utente {action}: {user_id[:8]}...")
@@ -142,7 +317,7 @@ class FirebaseService:
     def get_user(self, user_id: str) -> Optional[Dict]:
         """Ottieni dati utente"""
         try:
-            doc = db.collection("users").document(user_id).get()
+            doc = self._user_ref(user_id).get()
             if doc.exists:
                 return doc.to_dict()
             return None
@@ -154,21 +329,8 @@ class FirebaseService:
     def save_api_keys(self, user_id: str, api_keys: Dict[str, str]) -> bool:
         """Salva API keys criptate"""
         try:
-            encrypted_keys = {}
-            
-            # Cripta solo se presenti
-            if api_keys.get("groq_api_key"):
-                encrypted_keys["groq"] = self.crypto.encrypt(api_keys["groq_api_key"])
-            
-            if api_keys.get("gemini_api_key"):
-                encrypted_keys["gemini"] = self.crypto.encrypt(api_keys["gemini_api_key"])
-            
-            # Salva su Firestore
-            db.collection("users").document(user_id).update({
-                "api_keys": encrypted_keys,
-                "api_keys_configured": len(encrypted_keys) > 0,
-                "updated_at": datetime.utcnow().isoformat()
-            })
+            self._user_ref(user_id).update(self._api_keys_update(api_keys))
+            self.invalidate_api_keys(user_id)
             
             logger.info(f"🔑 API keys salvate per utente: {user_id[:8]}...")
             return True
@@ -179,21 +341,18 @@ class FirebaseService:
     
     def get_api_keys(self, user_id: str) -> Dict[str, str]:
         """Ottieni API keys decriptate"""
+        cached = self._cached_api_keys(user_id)
+        if cached is not None:
+            return cached
+        
+        generation = self._keys_generation(user_id)
         try:
-            doc = db.collection("users").document(user_id).get()
+            doc = self._user_ref(user_id).get()
             if not doc.exists:
                 return {}
             
-            data = doc.to_dict()
-            encrypted_keys = data.get("api_keys", {})
-            
-            decrypted_keys = {}
-            if "groq" in encrypted_keys:
-                decrypted_keys["groq_api_key"] = self.crypto.decrypt(encrypted_keys["groq"])
-            
-            if "gemini" in encrypted_keys:
-                decrypted_keys["gemini_api_key"] = self.crypto.decrypt(encrypted_keys["gemini"])
-            
+            decrypted_keys = self._decrypt_api_keys(doc.to_dict())
+            self._cache_api_keys(user_id, decrypted_keys, generation)
             return decrypted_keys
             
         except Exception as e:
@@ -201,26 +360,27 @@ class FirebaseService:
             return {}
     
     # ---------- GESTIONE CONVERSAZIONI ----------
-    def save_conversation(self, user_id: str, conversation_data: Dict) -> str:
+    def new_conversation_id(self, user_id: str) -> str:
+        """Genera lato client l'id di una nuova conversazione (nessuna RPC, "" se Firebase non è disponibile)"""
+        if not self.available:
+            return ""
+        try:
+            return self._user_ref(user_id).collection("conversations").document().id
+        except Exception as e:
+            logger.error(f"❌ Errore new_conversation_id: {e}")
+            return ""
+    
+    def save_conversation(self, user_id: str, conversation_data: Dict, conversation_id: Optional[str] = None) -> str:
         """Salva una conversazione"""
         try:
-            conv_ref = db.collection("users").document(user_id)\
-                .collection("conversations").document()
-            
-            # Aggiungi metadati
-            conversation_data["id"] = conv_ref.id
-            conversation_data["created_at"] = datetime.utcnow().isoformat()
-            conversation_data["user_id"] = user_id
-            
-            # Salva
-            conv_ref.set(conversation_data)
-            
-            # Aggiorna contatore utente
-            user_ref = db.collection("users").document(user_id)
-            user_ref.update({
-                "total_conversations": firestore.Increment(1),
-                "updated_at": datetime.utcnow().isoformat()
-            })
+            user_ref = self._user_ref(user_id)
+            conv_ref = user_ref.collection("conversations").document(conversation_id)
+            
+            # Salva conversazione e contatore utente in un unico commit
+            batch = self.db.batch()
+            batch.set(conv_ref, self._prepare_conversation(user_id, conv_ref, conversation_data))
+            batch.set(self._counter_shard(user_ref), self._conversation_counter(1), merge=True)
+            batch.commit()
             
             logger.info(f"💾 Conversazione salvata: {conv_ref.id}")
             return conv_ref.id
@@ -230,37 +390,44 @@ class FirebaseService:
             return ""
     
     def get_conversations(self, user_id: str, limit: int = 20) -> List[Dict]:
-        """Ottieni ultime conversazioni"""
+        """Ottieni ultime conversazioni (solo metadati)"""
         try:
-            convs_ref = db.collection("users").document(user_id)\
+            convs_ref = self._user_ref(user_id)\
                 .collection("conversations")\
+                .select(self.CONVERSATION_LIST_FIELDS)\
                 .order_by("created_at", direction=firestore.Query.DESCENDING)\
                 .limit(limit)
             
-            conversations = []
-            for doc in convs_ref.stream():
-                conv_data = doc.to_dict()
-                conv_data["id"] = doc.id
-                conversations.append(conv_data)
-            
-            return conversations
+            return [self._with_id(doc) for doc in convs_ref.stream()]
             
         except Exception as e:
             logger.error(f"❌ Errore get_conversations: {e}")
             return []
     
+    def get_conversation_full(self, user_id: str, conversation_id: str) -> Optional[Dict]:
+        """Ottieni una conversazione completa di messaggi"""
+        try:
+            doc = self._user_ref(user_id)\
+                .collection("conversations").document(conversation_id).get()
+            if not doc.exists:
+                return None
+            return self._with_id(doc)
+            
+        except Exception as e:
+            logger.error(f"❌ Errore get_conversation_full: {e}")
+            return None
+    
     def delete_conversation(self, user_id: str, conversation_id: str) -> bool:
         """Elimina una conversazione"""
         try:
-            db.collection("users").document(user_id)\
-                .collection("conversations").document(conversation_id).delete()
-            
-            # Aggiorna contatore
-            user_ref = db.collection("users").document(user_id)
-            user_ref.update({
-                "total_conversations": firestore.Increment(-1),
-                "updated_at": datetime.utcnow().isoformat()
-            })
+            user_ref = self._user_ref(user_id)
+            conv_ref = user_ref.collection("conversations").document(conversation_id)
+            
+            # Elimina e aggiorna contatore in un unico commit
+            batch = self.db.batch()
+            batch.delete(conv_ref)
+            batch.set(self._counter_shard(user_ref), self._conversation_counter(-1), merge=True)
+            batch.commit()
             
             return True
             
@@ -269,17 +436,202 @@ class FirebaseService:
             return False
     
     # ---------- STATISTICHE ----------
+    def get_conversation_count(self, user_id: str, user_data: Optional[Dict] = None) -> int:
+        """Totale conversazioni dell'utente"""
+        try:
+            shards = self._user_ref(user_id).collection("counters").stream()
+            return self._count_from_shards(user_data, shards)
+        except Exception as e:
+            logger.error(f"❌ Errore get_conversation_count: {e}")
+            return (user_data or {}).get("total_conversations", 0)
+    
     def update_token_usage(self, user_id: str, tokens_used: int):
         """Aggiorna contatore token"""
         try:
-            db.collection("users").document(user_id).update({
+            self._user_ref(user_id).update({
                 "total_tokens_used": firestore.Increment(tokens_used),
-                "updated_at": datetime.utcnow().isoformat()
+                "updated_at": firestore.SERVER_TIMESTAMP
             })
         except Exception as e:
             logger.error(f"❌ Errore update_token_usage: {e}")
+    
+    # ---------- VARIANTI ASYNC (AsyncClient) ----------
+    async def acreate_user_profile(self, user_id: str, email: str, display_name: str = None, photo_url: str = None) -> Dict[str, Any]:
+        """Crea o aggiorna profilo utente (async)"""
+        if not self.available:
+            return {"success": False, "error": "firebase_unavailable"}
+        
+        try:
+            user_ref = self._auser_ref(user_id)
+            
+            try:
+                await user_ref.update(self._profile_updates(display_name, photo_url))
+                action = "aggiornato"
+            except NotFound:
+                await user_ref.set(self._new_profile(user_id, email, display_name, photo_url))
+                action = "creato"
+            
+            logger.info(f"👤 Profilo utente {action}: {user_id[:8]}...")
+            return {"success": True, "action": action}
+            
+        except Exception as e:
+            logger.error(f"❌ Errore creazione profilo utente: {e}")
+            return {"success": False, "error": str(e)}
+    
+    async def aget_user(self, user_id: str) -> Optional[Dict]:
+        """Ottieni dati utente (async)"""
+        try:
+            doc = await self._auser_ref(user_id).get()
+            if doc.exists:
+                return doc.to_dict()
+            return None
+        except Exception as e:
+            logger.error(f"❌ Errore get_user: {e}")
+            return None
+    
+    async def asave_api_keys(self, user_id: str, api_keys: Dict[str, str]) -> bool:
+        """Salva API keys criptate (async)"""
+        try:
+            await self._auser_ref(user_id).update(self._api_keys_update(api_keys))
+            self.invalidate_api_keys(user_id)
+            
+            logger.info(f"🔑 API keys salvate per utente: {user_id[:8]}...")
+            return True
+            
+        except Exception as e:
+            logger.error(f"❌ Errore save_api_keys: {e}")
+            return False
+    
+    async def aget_api_keys(self, user_id: str) -> Dict[str, str]:
+        """Ottieni API keys decriptate (async)"""
+        cached = self._cached_api_keys(user_id)
+        if cached is not None:
+            return cached
+        
+        generation = self._keys_generation(user_id)
+        try:
+            doc = await self._auser_ref(user_id).get()
+            if not doc.exists:
+                return {}
+            
+            decrypted_keys = self._decrypt_api_keys(doc.to_dict())
+            self._cache_api_keys(user_id, decrypted_keys, generation)
+            return decrypted_keys
+            
+        except Exception as e:
+            logger.error(f"❌ Errore get_api_keys: {e}")
+            return {}
+    
+    async def asave_conversation(self, user_id: str, conversation_data: Dict, conversation_id: Optional[str] = None) -> str:
+        """Salva una conversazione (async)"""
+        try:
+            user_ref = self._auser_ref(user_id)
+            conv_ref = user_ref.collection("conversations").document(conversation_id)
+            
+            batch = self.adb.batch()
+            batch.set(conv_ref, self._prepare_conversation(user_id, conv_ref, conversation_data))
+            batch.set(self._counter_shard(user_ref), self._conversation_counter(1), merge=True)
+            await batch.commit()
+            
+            logger.info(f"💾 Conversazione salvata: {conv_ref.id}")
+            return conv_ref.id
+            
+        except Exception as e:
+            logger.error(f"❌ Errore save_conversation: {e}")
+            return ""
+    
+    async def asave_conversations_batch(self, items: List[Tuple[str, Optional[str], Dict]]) -> List[str]:
+        """Salva più conversazioni con commit a blocchi (async)"""
+        saved = []
+        for chunk in self._batch_chunks(items):
+            try:
+                batch = self.adb.batch()
+                ids = self._fill_conversation_batch(batch, chunk, self._auser_ref)
+                await batch.commit()
+                saved.extend(ids)
+            except Exception as e:
+                if InvalidArgument is None or not isinstance(e, InvalidArgument):
+                    # Timeout/UNAVAILABLE: il commit potrebbe essere già applicato,
+                    # ritentare raddoppierebbe gli Increment sui contatori
+                    logger.error(f"❌ Errore save_conversations_batch, {len(chunk)} conversazioni non salvate: {e}")
+                    continue
+                
+                # Documento rifiutato: il batch è atomico, si salvano le altre una per una
+                logger.error(f"❌ Errore save_conversations_batch, riprovo per singola conversazione: {e}")
+                for user_id, conversation_id, conversation_data in chunk:
+                    conv_id = await self.asave_conversation(user_id, conversation_data, conversation_id)
+                    if conv_id:
+                        saved.append(conv_id)
+        
+        logger.info(f"💾 Conversazioni salvate: {len(saved)}/{len(items)}")
+        return saved
+    
+    async def aget_conversations(self, user_id: str, limit: int = 20) -> List[Dict]:
+        """Ottieni ultime conversazioni, solo metadati (async)"""
+        try:
+            convs_ref = self._auser_ref(user_id)\
+                .collection("conversations")\
+                .select(self.CONVERSATION_LIST_FIELDS)\
+                .order_by("created_at", direction=firestore.Query.DESCENDING)\
+                .limit(limit)
+            
+            return [self._with_id(doc) async for doc in convs_ref.stream()]
+            
+        except Exception as e:
+            logger.error(f"❌ Errore get_conversations: {e}")
+            return []
+    
+    async def aget_conversation_full(self, user_id: str, conversation_id: str) -> Optional[Dict]:
+        """Ottieni una conversazione completa di messaggi (async)"""
+        try:
+            doc = await self._auser_ref(user_id)\
+                .collection("conversations").document(conversation_id).get()
+            if not doc.exists:
+                return None
+            return self._with_id(doc)
+            
+        except Exception as e:
+            logger.error(f"❌ Errore get_conversation_full: {e}")
+            return None
+    
+    async def adelete_conversation(self, user_id: str, conversation_id: str) -> bool:
+        """Elimina una conversazione (async)"""
+        try:
+            user_ref = self._auser_ref(user_id)
+            conv_ref = user_ref.collection("conversations").document(conversation_id)
+            
+            batch = self.adb.batch()
+            batch.delete(conv_ref)
+            batch.set(self._counter_shard(user_ref), self._conversation_counter(-1), merge=True)
+            await batch.commit()
+            
+            return True
+            
+        except Exception as e:
+            logger.error(f"❌ Errore delete_conversation: {e}")
+            return False
+    
+    async def aget_conversation_count(self, user_id: str, user_data: Optional[Dict] = None) -> int:
+        """Totale conversazioni dell'utente (async)"""
+        try:
+            shards = [doc async for doc in self._auser_ref(user_id).collection("counters").stream()]
+            return self._count_from_shards(user_data, shards)
+        except Exception as e:
+            logger.error(f"❌ Errore get_conversation_count: {e}")
+            return (user_data or {}).get("total_conversations", 0)
 
 # =========================
-# ISTANZA GLOBALE
+# ISTANZA GLOBALE (creata al primo utilizzo)
 # =========================
-firebase_service = FirebaseService()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_firebase_service() -> FirebaseService:
+    """Crea il servizio (e inizializza Firebase) una sola volta"""
+    return FirebaseService()
+
+class _LazyFirebaseService:
+    """Rimanda gli attributi al servizio, creato al primo accesso e non all'import"""
+    
+    def __getattr__(self, name: str):
+        return getattr(get_firebase_service(), name)
+
+firebase_service = _LazyFirebaseService()
@@ -2,10 +2,20 @@
 MAVKUS AI - CORE ENGINE
 """
 import os
+import re
 import json
+import time
+import asyncio
+import atexit
+import sqlite3
 import logging
+import threading
+import orjson
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from datetime import datetime
-from typing import Dict, List, Tuple, Optional, Any
+from typing import Dict, List, Tuple, Optional, Any, FrozenSet
 from dotenv import load_dotenv
 
 # Configurazione
@@ -13,23 +23,154 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Import LangChain
+# Import LangChain (solo messaggi)
 try:
-    from langchain_groq import ChatGroq
     from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-    from langchain_core.chat_history import InMemoryChatMessageHistory
     LANGCHAIN_AVAILABLE = True
 except ImportError:
     LANGCHAIN_AVAILABLE = False
     logger.error("❌ LangChain non disponibile")
 
-# Import Gemini
-try:
-    import google.generativeai as genai
-    GEMINI_AVAILABLE = True
-except ImportError:
-    GEMINI_AVAILABLE = False
-    logger.warning("⚠️ Gemini non disponibile")
+# Pool per la persistenza su disco fuori dal percorso della risposta
+_persist_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="mavkus-persist")
+atexit.register(_persist_pool.shutdown, wait=True)
+
+# Groq e Gemini vengono importati al primo utilizzo (riduce il cold start)
+_chat_groq_cls = None
+_genai_mod = None
+
+def _get_chat_groq():
+    """Importa ChatGroq una sola volta"""
+    global _chat_groq_cls
+    if _chat_groq_cls is None:
+        from langchain_groq import ChatGroq
+        _chat_groq_cls = ChatGroq
+    return _chat_groq_cls
+
+def _groq_async_client(api_key: str, http_client: Any):
+    """Client async Groq sul pool HTTP condiviso (None = client di default di ChatGroq)"""
+    if http_client is None:
+        return None
+    from groq import AsyncGroq
+    return AsyncGroq(api_key=api_key, http_client=http_client).chat.completions
+
+def _get_genai():
+    """Importa google.generativeai una sola volta"""
+    global _genai_mod
+    if _genai_mod is None:
+        import google.generativeai as genai
+        _genai_mod = genai
+    return _genai_mod
+
+# genai.configure è globale: si riconfigura solo se la chiave cambia
+_genai_configured_key = None
+_genai_lock = threading.Lock()
+
+def _configure_genai(api_key: str):
+    """Configura Gemini una volta per chiave"""
+    global _genai_configured_key
+    genai = _get_genai()
+    with _genai_lock:
+        if api_key != _genai_configured_key:
+            genai.configure(api_key=api_key)
+            _genai_configured_key = api_key
+    return genai
+
+# =========================
+# MEMORIA PERSISTENTE (SQLITE)
+# =========================
+class MemoryStore:
+    """Archivio SQLite (WAL) per la memoria di un utente"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS kv (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL
+            );
+        """)
+    
+    def write(self, messages: List[Tuple[str, str]] = (), rows: List[Tuple[str, bytes]] = ()):
+        """Scrive messaggi (role, content) e righe kv in un'unica transazione"""
+        ts = int(time.time())
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if messages:
+                    self._conn.executemany(
+                        "INSERT INTO messages (ts, role, content) VALUES (?, ?, ?)",
+                        [(ts, role, content) for role, content in messages]
+                    )
+                if rows:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", rows
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+    
+    def append_messages(self, messages: List[Tuple[str, str]]):
+        """Aggiunge più messaggi (role, content) in un'unica transazione"""
+        self.write(messages=messages)
+    
+    def recent_messages(self, limit: int) -> List[Tuple[str, str]]:
+        """Ultimi messaggi in ordine cronologico"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content FROM messages ORDER BY id DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return rows[::-1]
+    
+    def prune_messages(self, keep: int):
+        """Mantiene solo gli ultimi messaggi su disco"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM messages WHERE id <= (SELECT MAX(id) FROM messages) - ?",
+                (keep,)
+            )
+    
+    @staticmethod
+    def encode(items: Dict[str, Any]) -> List[Tuple[str, bytes]]:
+        """Serializza le chiavi in righe (key, value) pronte per put_rows"""
+        return [(key, orjson.dumps(value, default=list)) for key, value in items.items()]
+    
+    def put_many(self, items: Dict[str, Any]):
+        """Aggiorna più chiavi in un'unica transazione"""
+        self.put_rows(self.encode(items))
+    
+    def put_rows(self, rows: List[Tuple[str, bytes]]):
+        """Scrive righe già serializzate in un'unica transazione"""
+        self.write(rows=rows)
+    
+    def get_all(self) -> Dict[str, Any]:
+        """Legge tutte le chiavi salvate"""
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM kv").fetchall()
+        return {key: orjson.loads(value) for key, value in rows}
+    
+    def clear(self):
+        """Svuota l'archivio"""
+        with self._lock:
+            self._conn.execute("DELETE FROM messages")
+            self._conn.execute("DELETE FROM kv")
+    
+    def close(self):
+        """Chiude la connessione (le operazioni successive falliscono)"""
+        with self._lock:
+            self._conn.close()
 
 # =========================
 # GEMINI SPECIALIST
@@ -44,53 +185,78 @@ class GeminiSpecialist:
         self.successes = 0
         self.available = False
         
-        if GEMINI_AVAILABLE and api_key:
+        if api_key:
             try:
-                genai.configure(api_key=api_key)
+                genai = _configure_genai(api_key)
                 self.model = genai.GenerativeModel('gemini-pro')
                 self.available = True
                 logger.info(f"✅ {self.name} attivo")
+            except ImportError:
+                logger.warning("⚠️ Gemini non disponibile")
+                self.model = None
             except Exception as e:
                 logger.error(f"❌ Errore inizializzazione Gemini: {e}")
                 self.model = None
         else:
             self.model = None
     
+    def _build_prompt(self, question: str, context: str) -> str:
+        """Prompt per lo specialista"""
+        return f"""CONTESTO UTENTE: {context}
+
+DOMANDA: {question}
+
+Sei un esperto in {self.specialty}. Rispondi in modo dettagliato, scientifico ma comprensibile."""
+    
+    def _unavailable(self) -> Dict[str, Any]:
+        return {
+            "answer": "❌ Gemini non disponibile",
+            "success": False,
+            "ai_name": self.name
+        }
+    
+    def _result(self, response) -> Dict[str, Any]:
+        answer = response.text if hasattr(response, 'text') else str(response)
+        self.successes += 1
+        return {
+            "answer": answer,
+            "ai_name": self.name,
+            "success": True
+        }
+    
+    def _error(self, e: Exception) -> Dict[str, Any]:
+        logger.error(f"❌ Errore consulto Gemini: {e}")
+        return {
+            "answer": f"❌ Errore Gemini: {str(e)[:100]}",
+            "success": False,
+            "ai_name": self.name
+        }
+    
     def consult(self, question: str, context: str = "") -> Dict[str, Any]:
         """Consulta Gemini"""
         if not self.available or not self.model:
-            return {
-                "answer": "❌ Gemini non disponibile",
-                "success": False,
-                "ai_name": self.name
-            }
+            return self._unavailable()
         
         self.consultations += 1
         
         try:
-            prompt = f"""CONTESTO UTENTE: {context}
-
-DOMANDA: {question}
-
-Sei un esperto in {self.specialty}. Rispondi in modo dettagliato, scientifico ma comprensibile."""
-            
-            response = self.model.generate_content(prompt)
-            answer = response.text if hasattr(response, 'text') else str(response)
-            
-            self.successes += 1
-            return {
-                "answer": answer,
-                "ai_name": self.name,
-                "success": True
-            }
-            
+            response = self.model.generate_content(self._build_prompt(question, context))
+            return self._result(response)
         except Exception as e:
-            logger.error(f"❌ Errore consulto Gemini: {e}")
-            return {
-                "answer": f"❌ Errore Gemini: {str(e)[:100]}",
-                "success": False,
-                "ai_name": self.name
-            }
+            return self._error(e)
+    
+    async def aconsult(self, question: str, context: str = "") -> Dict[str, Any]:
+        """Consulta Gemini (async)"""
+        if not self.available or not self.model:
+            return self._unavailable()
+        
+        self.consultations += 1
+        
+        try:
+            response = await self.model.generate_content_async(self._build_prompt(question, context))
+            return self._result(response)
+        except Exception as e:
+            return self._error(e)
     
     def get_stats(self) -> Dict[str, Any]:
         """Ottieni statistiche"""
@@ -110,19 +276,46 @@ Sei un esperto in {self.specialty}. Rispondi in modo dettagliato, scientifico ma
 class MavkusAI:
     """AI con routing intelligente e auto-valutazione"""
     
+    # Stile: pattern precompilati (includono frasi, es. "per favore")
+    _FORMAL_RE = re.compile(r"gentilmente|per favore")
+    _CASUAL_RE = re.compile(r"ciao|hey")
+    _TECHNICAL_RE = re.compile(r"funzione|codice")
+    # Interessi e routing: lookup sulle parole del messaggio
+    _TOKEN_RE = re.compile(r"[a-zà-ÿ]+")
+    _INTEREST_KW = (
+        "fisica", "chimica", "biologia", "matematica", "scienza",
+        "python", "javascript", "programmazione", "codice", "algoritmo"
+    )
+    _SCIENCE_KW = frozenset({
+        "fisica", "chimica", "biologia", "matematica",
+        "atomo", "molecola", "cellula", "equazione",
+        "teorema", "energia", "forza", "gravità",
+        "relatività", "quantistica", "organico"
+    })
+    _CORE_SCIENCE = frozenset({"fisica", "chimica", "biologia"})
+    # Estrazione JSON dalla risposta del critico (con o senza ```json)
+    _JSON_DECODER = json.JSONDecoder()
+    
+    # Messaggi mantenuti su disco / in memoria per il prompt
+    MEMORY_MESSAGES = 50
+    HISTORY_MESSAGES = 20
+    
     def __init__(
         self,
         user_id: str,
         groq_api_key: str = None,
         gemini_api_key: str = None,
         model_name: str = "llama-3.3-70b-versatile",
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        http_client: Any = None
     ):
         self.user_id = user_id
-        self.save_file = f"user_memories/mavkus_memory_{user_id}.json"
+        self.save_file = f"user_memories/mavkus_memory_{user_id}.db"
+        self.legacy_file = f"user_memories/mavkus_memory_{user_id}.json"
         
         # Crea directory se non esiste
         os.makedirs("user_memories", exist_ok=True)
+        self.store = MemoryStore(self.save_file)
         
         # Inizializza Groq
         groq_key = groq_api_key or os.getenv("GROQ_API_KEY")
@@ -130,18 +323,23 @@ class MavkusAI:
             raise ValueError("GROQ_API_KEY mancante")
         
         try:
+            ChatGroq = _get_chat_groq()
+            # Le chiamate async riusano le connessioni del client condiviso
+            async_client = _groq_async_client(groq_key, http_client)
             self.model = ChatGroq(
                 model=model_name,
                 temperature=temperature,
                 api_key=groq_key,
-                max_tokens=4096
+                max_tokens=4096,
+                async_client=async_client
             )
             
             self.critic_model = ChatGroq(
                 model=model_name,
                 temperature=0.3,
                 api_key=groq_key,
-                max_tokens=1024
+                max_tokens=1024,
+                async_client=async_client
             )
             
             logger.info(f"🧠 Modello Groq inizializzato: {model_name}")
@@ -153,11 +351,23 @@ class MavkusAI:
         self.gemini = GeminiSpecialist(gemini_api_key)
         
         # Inizializza memoria
-        self.chat_history = InMemoryChatMessageHistory()
+        self._history: deque = deque(maxlen=self.HISTORY_MESSAGES)
         self.user_profile = self._init_user_profile()
         self.learned_patterns = self._init_learned_patterns()
         self.routing_stats = self._init_routing_stats()
         
+        # Profilo serializzato per il prompt, rigenerato solo se cambia
+        self._prompt_dirty = True
+        self._cached_profile_json = ""
+        
+        # Messaggi in attesa di scrittura su disco (fuori dall'event loop, in ordine)
+        self._pending_messages: deque = deque()
+        self._flush_lock = threading.Lock()
+        
+        # Un turno async alla volta: achat cede il controllo a metà turno
+        # e l'istanza (cronologia, contatori) è condivisa tra le richieste
+        self._turn_lock = asyncio.Lock()
+        
         # Carica memoria esistente
         self.load_memory()
         
@@ -173,9 +383,9 @@ class MavkusAI:
             "language_level": "medium",
             "quality_metrics": {
                 "avg_response_score": 0.0,
-                "improvement_trend": [],
-                "weak_areas": [],
-                "strong_areas": []
+                "improvement_trend": deque(maxlen=20),
+                "weak_areas": deque(maxlen=5),
+                "strong_areas": deque(maxlen=5)
             }
         }
     
@@ -185,7 +395,7 @@ class MavkusAI:
             "successful_responses": [],
             "failed_responses": [],
             "improvement_strategies": [],
-            "gemini_consultations": []
+            "gemini_consultations": deque(maxlen=100)
         }
     
     def _init_routing_stats(self) -> Dict[str, Any]:
@@ -200,10 +410,16 @@ class MavkusAI:
     # ---------- SISTEMA PROMPT ----------
     def _get_system_prompt(self) -> str:
         """Genera prompt di sistema"""
+        if self._prompt_dirty:
+            self._cached_profile_json = orjson.dumps(
+                self.user_profile, default=list, option=orjson.OPT_INDENT_2
+            ).decode()
+            self._prompt_dirty = False
+        
         return f"""Sei MAVKUS, un'AI intelligente con accesso a uno specialista scientifico.
 
 PROFILO UTENTE:
-{json.dumps(self.user_profile, ensure_ascii=False, indent=2)}
+{self._cached_profile_json}
 
 SPECIALISTA DISPONIBILE:
 - Gemini Pro: {self.gemini.specialty}
@@ -220,81 +436,82 @@ ISTRUZIONI:
 4. Sii chiaro, utile e conciso"""
     
     # ---------- ANALISI UTENTE ----------
-    def analyze_user_message(self, message: str):
-        """Analizza stile e interessi utente"""
+    def _prepare_message(self, message: str) -> Tuple[str, FrozenSet[str]]:
+        """Minuscolo e insieme delle parole, calcolati una volta per messaggio"""
         message_lower = message.lower()
+        return message_lower, frozenset(self._TOKEN_RE.findall(message_lower))
+    
+    def analyze_user_message(self, message: str, prepared: Optional[Tuple[str, FrozenSet[str]]] = None):
+        """Analizza stile e interessi utente"""
+        message_lower, tokens = prepared or self._prepare_message(message)
         
         # Analizza stile
-        if "gentilmente" in message_lower or "per favore" in message_lower:
-            self.user_profile["style"] = "formal"
-        elif "ciao" in message_lower or "hey" in message_lower:
-            self.user_profile["style"] = "casual"
-        elif "funzione" in message_lower or "codice" in message_lower:
-            self.user_profile["style"] = "technical"
+        if self._FORMAL_RE.search(message_lower):
+            style = "formal"
+        elif self._CASUAL_RE.search(message_lower):
+            style = "casual"
+        elif self._TECHNICAL_RE.search(message_lower):
+            style = "technical"
         else:
-            self.user_profile["style"] = "neutral"
+            style = "neutral"
         
-        # Rileva interessi
-        science_keywords = ["fisica", "chimica", "biologia", "matematica", "scienza"]
-        coding_keywords = ["python", "javascript", "programmazione", "codice", "algoritmo"]
+        if style != self.user_profile["style"]:
+            self.user_profile["style"] = style
+            self._prompt_dirty = True
         
-        for keyword in science_keywords + coding_keywords:
-            if keyword in message_lower and keyword not in self.user_profile["topics_of_interest"]:
-                self.user_profile["topics_of_interest"].append(keyword)
+        # Rileva interessi
+        topics = self.user_profile["topics_of_interest"]
+        for keyword in self._INTEREST_KW:
+            if keyword in tokens and keyword not in topics:
+                topics.append(keyword)
+                self._prompt_dirty = True
         
         # Limita lista interessi
         if len(self.user_profile["topics_of_interest"]) > 10:
             self.user_profile["topics_of_interest"] = self.user_profile["topics_of_interest"][-10:]
     
     # ---------- ROUTING INTELLIGENTE ----------
-    def should_route_to_gemini(self, question: str) -> bool:
+    def should_route_to_gemini(self, question: str, prepared: Optional[Tuple[str, FrozenSet[str]]] = None) -> bool:
         """Decide se inviare a Gemini"""
-        science_keywords = [
-            "fisica", "chimica", "biologia", "matematica",
-            "atomo", "molecola", "cellula", "equazione",
-            "teorema", "energia", "forza", "gravità",
-            "relatività", "quantistica", "organico"
-        ]
-        
-        question_lower = question.lower()
-        science_count = sum(1 for kw in science_keywords if kw in question_lower)
+        _, tokens = prepared or self._prepare_message(question)
+        found = tokens & self._SCIENCE_KW
         
-        return science_count >= 2 or any(kw in question_lower for kw in ["fisica", "chimica", "biologia"])
+        return len(found) >= 2 or not found.isdisjoint(self._CORE_SCIENCE)
     
     # ---------- CHAT ----------
-    def chat(self, user_message: str, enable_critique: bool = True) -> Tuple[str, Dict[str, Any]]:
-        """Elabora un messaggio utente"""
+    def _start_turn(self, user_message: str) -> bool:
+        """Aggiorna profilo e cronologia, decide il routing"""
         # Analizza utente
-        self.analyze_user_message(user_message)
+        prepared = self._prepare_message(user_message)
+        self.analyze_user_message(user_message, prepared)
         self.user_profile["conversation_count"] += 1
         self.routing_stats["total_questions"] += 1
         
         # Aggiungi a cronologia
-        self.chat_history.add_user_message(user_message)
+        self._add_message("human", user_message)
         
         # Routing decision
-        route_to_gemini = self.should_route_to_gemini(user_message)
-        gemini_response = None
-        
+        route_to_gemini = self.should_route_to_gemini(user_message, prepared)
         if route_to_gemini and self.gemini.available:
             logger.info("🔬 Domanda scientifica → Consulto Gemini")
             self.routing_stats["routed_to_gemini"] += 1
-            
-            # Consulta Gemini
-            context = f"Stile: {self.user_profile['style']}"
-            gemini_response = self.gemini.consult(user_message, context)
-            
-            if gemini_response["success"]:
-                self.learned_patterns["gemini_consultations"].append({
-                    "timestamp": datetime.now().isoformat(),
-                    "question": user_message[:100],
-                    "success": True
-                })
         else:
             self.routing_stats["handled_by_coordinator"] += 1
         
-        # Prepara messaggi per Groq
-        messages = [SystemMessage(content=self._get_system_prompt())]
+        return route_to_gemini
+    
+    def _record_gemini(self, user_message: str, gemini_response: Dict[str, Any]):
+        """Registra una consulenza Gemini riuscita"""
+        if gemini_response["success"]:
+            self.learned_patterns["gemini_consultations"].append({
+                "timestamp": datetime.now().isoformat(),
+                "question": user_message[:100],
+                "success": True
+            })
+    
+    def _build_messages(self, system_prompt: str, gemini_response: Optional[Dict[str, Any]], history: List[Any]) -> List[Any]:
+        """Prepara messaggi per Groq"""
+        messages = [SystemMessage(content=system_prompt)]
         
         # Aggiungi risposta Gemini se disponibile
         if gemini_response and gemini_response["success"]:
@@ -303,16 +520,44 @@ ISTRUZIONI:
             ))
         
         # Aggiungi cronologia
-        messages.extend(self.chat_history.messages[-10:])  # Ultimi 10 messaggi
+        messages.extend(history)
+        return messages
+    
+    def _finish_turn(self, route_to_gemini: bool, gemini_response: Optional[Dict[str, Any]], critique: Dict[str, Any]) -> Dict[str, Any]:
+        """Salvataggio periodico e metadata della risposta"""
+        # Salva periodicamente (in background)
+        if self.user_profile["conversation_count"] % 5 == 0:
+            self.save_memory(background=True)
+        
+        return {
+            "routed_to_gemini": route_to_gemini,
+            "gemini_used": gemini_response["success"] if gemini_response else False,
+            "gemini_response": gemini_response if gemini_response else None,
+            "critique": critique
+        }
+    
+    def chat(self, user_message: str, enable_critique: bool = True) -> Tuple[str, Dict[str, Any]]:
+        """Elabora un messaggio utente"""
+        route_to_gemini = self._start_turn(user_message)
+        gemini_response = None
+        
+        if route_to_gemini and self.gemini.available:
+            # Consulta Gemini
+            context = f"Stile: {self.user_profile['style']}"
+            gemini_response = self.gemini.consult(user_message, context)
+            self._record_gemini(user_message, gemini_response)
+        
+        messages = self._build_messages(
+            self._get_system_prompt(), gemini_response, self._recent_history(10)  # Ultimi 10 messaggi
+        )
         
         # Genera risposta
         try:
             response = self.model.invoke(messages)
             ai_response = response.content
-            self.chat_history.add_ai_message(ai_response)
         except Exception as e:
             ai_response = f"❌ Errore generazione risposta: {str(e)}"
-            self.chat_history.add_ai_message(ai_response)
+        self._add_message("ai", ai_response)
         
         # Auto-valutazione
         critique = {}
@@ -320,25 +565,48 @@ ISTRUZIONI:
             critique = self._critique_response(user_message, ai_response)
             self._learn_from_critique(critique)
         
-        # Salva periodicamente
-        if self.user_profile["conversation_count"] % 5 == 0:
-            self.save_memory()
+        return ai_response, self._finish_turn(route_to_gemini, gemini_response, critique)
+    
+    async def achat(self, user_message: str, enable_critique: bool = True) -> Tuple[str, Dict[str, Any]]:
+        """Elabora un messaggio utente (async, un turno alla volta per istanza)"""
+        async with self._turn_lock:
+            return await self._achat_turn(user_message, enable_critique)
+    
+    async def _achat_turn(self, user_message: str, enable_critique: bool) -> Tuple[str, Dict[str, Any]]:
+        """Turno di chat async: stessa sequenza di chat() senza bloccare l'event loop"""
+        route_to_gemini = self._start_turn(user_message)
+        gemini_response = None
         
-        # Metadata
-        metadata = {
-            "routed_to_gemini": route_to_gemini,
-            "gemini_used": gemini_response["success"] if gemini_response else False,
-            "gemini_response": gemini_response if gemini_response else None,
-            "critique": critique
-        }
+        if route_to_gemini and self.gemini.available:
+            # Consulta Gemini (la risposta entra nel prompt di Groq)
+            context = f"Stile: {self.user_profile['style']}"
+            gemini_response = await self.gemini.aconsult(user_message, context)
+            self._record_gemini(user_message, gemini_response)
+        
+        messages = self._build_messages(
+            self._get_system_prompt(), gemini_response, self._recent_history(10)  # Ultimi 10 messaggi
+        )
+        
+        # Genera risposta
+        try:
+            response = await self.model.ainvoke(messages)
+            ai_response = response.content
+        except Exception as e:
+            ai_response = f"❌ Errore generazione risposta: {str(e)}"
+        self._add_message("ai", ai_response)
+        
+        # Auto-valutazione
+        critique = {}
+        if enable_critique:
+            critique = await self._acritique_response(user_message, ai_response)
+            self._learn_from_critique(critique)
         
-        return ai_response, metadata
+        return ai_response, self._finish_turn(route_to_gemini, gemini_response, critique)
     
     # ---------- AUTO-VALUTAZIONE ----------
-    def _critique_response(self, user_message: str, ai_response: str) -> Dict[str, Any]:
-        """Valuta la risposta generata"""
-        try:
-            prompt = f"""Valuta questa risposta AI (1-10):
+    def _critique_messages(self, user_message: str, ai_response: str) -> List[Any]:
+        """Messaggi per il modello critico"""
+        prompt = f"""Valuta questa risposta AI (1-10):
 
 DOMANDA: {user_message}
 RISPOSTA: {ai_response}
@@ -351,34 +619,48 @@ Criteri:
 - Utilità pratica
 
 Rispondi in formato JSON:"""
-            
-            critic_response = self.critic_model.invoke([
-                SystemMessage(content="Sei un critico obiettivo e preciso."),
-                HumanMessage(content=prompt)
-            ])
-            
-            # Estrai JSON dalla risposta
-            content = critic_response.content.strip()
-            if "```json" in content:
-                json_str = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                json_str = content.split("```")[1].split("```")[0].strip()
-            else:
-                json_str = content
-            
-            critique = json.loads(json_str)
-            return critique
-            
+        
+        return [
+            SystemMessage(content="Sei un critico obiettivo e preciso."),
+            HumanMessage(content=prompt)
+        ]
+    
+    def _parse_critique(self, content: str) -> Dict[str, Any]:
+        """Estrai il primo oggetto JSON dalla risposta del critico"""
+        start = content.find("{")
+        if start == -1:
+            raise ValueError("JSON non trovato nella valutazione")
+        
+        critique, _ = self._JSON_DECODER.raw_decode(content, start)
+        return critique
+    
+    def _default_critique(self, e: Exception) -> Dict[str, Any]:
+        """Valutazione di ripiego"""
+        logger.error(f"❌ Errore auto-valutazione: {e}")
+        return {
+            "scores": {"rilevanza": 7, "chiarezza": 7, "completezza": 7, "accuratezza": 7, "utilita": 7},
+            "overall_score": 7.0,
+            "strengths": ["Risposta generica"],
+            "weaknesses": ["Valutazione non disponibile"],
+            "improvement_suggestion": "Continua a migliorare",
+            "category": "generale"
+        }
+    
+    def _critique_response(self, user_message: str, ai_response: str) -> Dict[str, Any]:
+        """Valuta la risposta generata"""
+        try:
+            critic_response = self.critic_model.invoke(self._critique_messages(user_message, ai_response))
+            return self._parse_critique(critic_response.content)
         except Exception as e:
-            logger.error(f"❌ Errore auto-valutazione: {e}")
-            return {
-                "scores": {"rilevanza": 7, "chiarezza": 7, "completezza": 7, "accuratezza": 7, "utilita": 7},
-                "overall_score": 7.0,
-                "strengths": ["Risposta generica"],
-                "weaknesses": ["Valutazione non disponibile"],
-                "improvement_suggestion": "Continua a migliorare",
-                "category": "generale"
-            }
+            return self._default_critique(e)
+    
+    async def _acritique_response(self, user_message: str, ai_response: str) -> Dict[str, Any]:
+        """Valuta la risposta generata (async)"""
+        try:
+            critic_response = await self.critic_model.ainvoke(self._critique_messages(user_message, ai_response))
+            return self._parse_critique(critic_response.content)
+        except Exception as e:
+            return self._default_critique(e)
     
     def _learn_from_critique(self, critique: Dict[str, Any]):
         """Apprende dalla critica"""
@@ -392,91 +674,180 @@ Rispondi in formato JSON:"""
         
         # Aggiorna trend
         metrics["improvement_trend"].append(score)
-        if len(metrics["improvement_trend"]) > 20:
-            metrics["improvement_trend"] = metrics["improvement_trend"][-20:]
         
-        # Identifica aree forti/deboli
+        # Identifica aree forti/deboli (deque limitate alle ultime 5)
         for area, value in critique.get("scores", {}).items():
             if value >= 8 and area not in metrics["strong_areas"]:
                 metrics["strong_areas"].append(area)
             elif value <= 5 and area not in metrics["weak_areas"]:
                 metrics["weak_areas"].append(area)
-        
-        # Limita liste
-        if len(metrics["strong_areas"]) > 5:
-            metrics["strong_areas"] = metrics["strong_areas"][-5:]
-        if len(metrics["weak_areas"]) > 5:
-            metrics["weak_areas"] = metrics["weak_areas"][-5:]
     
     # ---------- GESTIONE MEMORIA ----------
-    def save_memory(self):
-        """Salva memoria su file"""
+    def _restore_bounded_lists(self):
+        """Riconverte in deque limitate le liste caricate da JSON"""
+        metrics = self.user_profile["quality_metrics"]
+        metrics["improvement_trend"] = deque(metrics.get("improvement_trend", []), maxlen=20)
+        metrics["weak_areas"] = deque(metrics.get("weak_areas", []), maxlen=5)
+        metrics["strong_areas"] = deque(metrics.get("strong_areas", []), maxlen=5)
+        
+        patterns = self.learned_patterns
+        patterns["gemini_consultations"] = deque(patterns.get("gemini_consultations", []), maxlen=100)
+    
+    def add_user_message(self, content: str):
+        """Aggiunge un messaggio utente alla cronologia"""
+        self._history.append(HumanMessage(content=content))
+    
+    def add_ai_message(self, content: str):
+        """Aggiunge una risposta AI alla cronologia"""
+        self._history.append(AIMessage(content=content))
+    
+    def _recent_history(self, n: int) -> List[Any]:
+        """Ultimi n messaggi in ordine cronologico"""
+        return list(islice(reversed(self._history), n))[::-1]
+    
+    def _add_message(self, role: str, content: str):
+        """Aggiunge un messaggio alla cronologia e all'archivio"""
+        if role == "human":
+            self.add_user_message(content)
+        else:
+            self.add_ai_message(content)
+        
+        # Scrittura su disco nel pool di persistenza
+        self._pending_messages.append((role, content))
+        _persist_pool.submit(self._flush_messages)
+    
+    def _flush_messages(self):
+        """Scrive i messaggi in attesa (svuotamento e insert atomici: l'ordine è preservato)"""
+        with self._flush_lock:
+            messages = []
+            while self._pending_messages:
+                messages.append(self._pending_messages.popleft())
+            if not messages:
+                return
+            try:
+                self.store.append_messages(messages)
+            except Exception as e:
+                logger.error(f"❌ Errore salvataggio messaggio: {e}")
+    
+    def save_memory(self, background: bool = False):
+        """Salva profilo, pattern e statistiche"""
         try:
-            data = {
-                "user_id": self.user_id,
+            # Serializzato subito: il thread non vede le modifiche dei turni successivi
+            rows = MemoryStore.encode({
                 "user_profile": self.user_profile,
                 "learned_patterns": self.learned_patterns,
                 "routing_stats": self.routing_stats,
                 "gemini_stats": self.gemini.get_stats(),
-                "chat_history": [
-                    {
-                        "role": "human" if isinstance(msg, HumanMessage) else "ai",
-                        "content": msg.content,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    for msg in self.chat_history.messages[-50:]  # Ultimi 50 messaggi
-                ],
                 "last_saved": datetime.now().isoformat()
-            }
+            })
+            
+            if background:
+                _persist_pool.submit(self._write_memory, rows)
+            else:
+                self._write_memory(rows)
             
-            with open(self.save_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+        except Exception as e:
+            logger.error(f"❌ Errore salvataggio memoria: {e}")
+    
+    def _write_memory(self, rows: List[Tuple[str, bytes]]):
+        """Scrive la memoria serializzata nell'archivio SQLite"""
+        try:
+            self.store.put_rows(rows)
+            self.store.prune_messages(self.MEMORY_MESSAGES)
             
             logger.info(f"💾 Memoria salvata: {self.save_file}")
             
         except Exception as e:
             logger.error(f"❌ Errore salvataggio memoria: {e}")
     
+    def _migrate_legacy_memory(self):
+        """Importa una volta la vecchia memoria JSON nell'archivio SQLite"""
+        with open(self.legacy_file, 'rb') as f:
+            data = orjson.loads(f.read())
+        
+        messages = [
+            (msg_data["role"], msg_data["content"])
+            for msg_data in data.get("chat_history", [])[-self.MEMORY_MESSAGES:]
+        ]
+        rows = MemoryStore.encode({
+            key: data[key]
+            for key in ("user_profile", "learned_patterns", "routing_stats")
+            if key in data
+        })
+        # Marcatore: il kv non resta vuoto anche se il JSON non aveva questi campi
+        rows += MemoryStore.encode({"migrated_from_json": datetime.now().isoformat()})
+        
+        # Tutto o niente: un errore non lascia messaggi da duplicare al prossimo caricamento
+        self.store.write(messages=messages, rows=rows)
+        
+        os.replace(self.legacy_file, self.legacy_file + ".migrated")
+        logger.info(f"📦 Memoria JSON migrata in SQLite: {self.save_file}")
+    
     def load_memory(self):
-        """Carica memoria da file"""
+        """Carica memoria dall'archivio"""
         try:
-            if not os.path.exists(self.save_file):
+            data = self.store.get_all()
+            if not data and os.path.exists(self.legacy_file):
+                self._migrate_legacy_memory()
+                data = self.store.get_all()
+            
+            if not data:
                 logger.info("🆕 Nuova memoria creata")
                 return
             
-            with open(self.save_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
             # Carica profilo utente
             self.user_profile = data.get("user_profile", self.user_profile)
             self.learned_patterns = data.get("learned_patterns", self.learned_patterns)
             self.routing_stats = data.get("routing_stats", self.routing_stats)
+            self._restore_bounded_lists()
+            self._prompt_dirty = True
             
             # Ricostruisci cronologia
-            self.chat_history.clear()
-            for msg_data in data.get("chat_history", []):
-                if msg_data["role"] == "human":
-                    self.chat_history.add_user_message(msg_data["content"])
+            self._history.clear()
+            history = self.store.recent_messages(self.HISTORY_MESSAGES)
+            for role, content in history:
+                if role == "human":
+                    self.add_user_message(content)
                 else:
-                    self.chat_history.add_ai_message(msg_data["content"])
+                    self.add_ai_message(content)
             
-            logger.info(f"✅ Memoria caricata: {len(data.get('chat_history', []))} messaggi")
+            logger.info(f"✅ Memoria caricata: {len(history)} messaggi")
             
         except Exception as e:
             logger.error(f"⚠️ Errore caricamento memoria: {e}")
     
     def clear_memory(self):
         """Cancella memoria"""
-        self.chat_history.clear()
+        self._history.clear()
         self.user_profile = self._init_user_profile()
         self.learned_patterns = self._init_learned_patterns()
         self.routing_stats = self._init_routing_stats()
+        self._prompt_dirty = True
         
-        if os.path.exists(self.save_file):
-            os.remove(self.save_file)
+        with self._flush_lock:
+            self._pending_messages.clear()
+            self.store.clear()
+        if os.path.exists(self.legacy_file):
+            os.remove(self.legacy_file)
         
         logger.info("🧹 Memoria azzerata")
     
+    def close(self):
+        """Scrive messaggi in attesa e memoria, poi chiude l'archivio"""
+        try:
+            self._flush_messages()
+            self.save_memory()
+            with self._flush_lock:
+                self.store.close()
+            logger.info(f"📪 Istanza chiusa: {self.user_id[:8]}...")
+        except Exception as e:
+            logger.error(f"❌ Errore chiusura istanza: {e}")
+    
+    async def aclose(self):
+        """Chiude l'istanza dopo l'eventuale turno in corso (async)"""
+        async with self._turn_lock:
+            await asyncio.to_thread(self.close)
+    
     # ---------- UTILITY ----------
     def get_stats(self) -> Dict[str, Any]:
         """Ottieni statistiche complete"""
@@ -15,11 +15,15 @@ if __name__ == "__main__":
     # Su Windows, usa reload=False
     import sys
     use_reload = "--reload" in sys.argv and sys.platform != "win32"
+    # uvloop non esiste su Windows
+    loop = "asyncio" if sys.platform == "win32" else "uvloop"
     
     uvicorn.run(
         "server:app",
         host="0.0.0.0",
         port=8000,
         reload=use_reload,
+        loop=loop,
+        http="httptools",
         log_level="info"
     )
\ No newline at end of file
@@ -1,40 +1,50 @@
 """
 FastAPI Server per MAVKUS AI
 """
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import Dict, Optional, Any
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, StringConstraints
+from typing import Annotated, Callable, Dict, List, Tuple, Optional, Any
 import os
+import time
+import httpx
+import asyncio
 import logging
-from datetime import datetime
-from functools import lru_cache
+from collections import OrderedDict
+from datetime import datetime, timezone
 
 # Configurazione
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Import servizi
-from firebase_service import firebase_service
+from firebase_service import firebase_service, get_firebase_service
 from mavkus import MavkusAI
 
 # =========================
 # MODELLI PYDANTIC
 # =========================
-class SaveAPIKeysRequest(BaseModel):
+MessageText = Annotated[str, StringConstraints(min_length=1, max_length=2000)]
+
+class RequestModel(BaseModel):
+    """Base delle request: immutabili, campi extra ignorati"""
+    model_config = ConfigDict(extra="ignore", str_max_length=2000, frozen=True)
+
+class SaveAPIKeysRequest(RequestModel):
     user_id: str
     groq_api_key: Optional[str] = None
     gemini_api_key: Optional[str] = None
 
-class ChatRequest(BaseModel):
+class ChatRequest(RequestModel):
     user_id: str
-    message: str = Field(..., min_length=1, max_length=2000)
+    message: MessageText
     enable_critique: bool = True
 
-class InitRequest(BaseModel):
+class InitRequest(RequestModel):
     user_id: str
 
-class UserProfileRequest(BaseModel):
+class UserProfileRequest(RequestModel):
     user_id: str
     email: str
     display_name: Optional[str] = None
@@ -48,45 +58,289 @@ app = FastAPI(
     description="API intelligente multi-AI con Groq e Gemini",
     version="3.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse
 )
 
-# CORS
+# CORS ("*" è già il caso veloce di Starlette: nessun confronto sull'origin)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],   # ✅ ora puoi
     allow_credentials=False,  # ✅ IMPORTANTISSIMO
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # preflight in cache nel browser per 24h
 )
 
+# =========================
+# FIREBASE
+# =========================
+@app.on_event("startup")
+async def init_firebase():
+    """Inizializza Firebase all'avvio, fuori dall'event loop (non all'import)"""
+    await asyncio.to_thread(get_firebase_service)
+
+# =========================
+# HTTP CLIENT CONDIVISO
+# =========================
+# Limiti del pool: il default httpx (100) accoda le richieste nei picchi,
+# ogni chat fa fino a due chiamate Groq (risposta + critica)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "500"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "200"))
+HTTP_KEEPALIVE_EXPIRY = 60  # secondi
+
+@app.on_event("startup")
+async def start_http_client():
+    """Un solo pool di connessioni per tutte le chiamate LLM"""
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+    )
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await app.state.http.aclose()
+
 # =========================
 # DEPENDENCIES & CACHING
 # =========================
-@lru_cache(maxsize=100)
-def _create_ai_instance(user_id: str) -> MavkusAI:
-    """Factory interna per istanze AI con caching"""
+AI_CACHE_SIZE = 1000
+AI_CACHE_TTL = 3600  # secondi di inattività
+
+class AIInstanceCache:
+    """Istanze AI per utente: LRU con scadenza per inattività.
+    Ogni istanza che esce dalla cache (scadenza, LRU, invalidazione) passa a on_evict."""
+    
+    def __init__(self, maxsize: int, ttl: float, on_evict: Callable[[str, MavkusAI], None]):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._on_evict = on_evict
+        # user_id -> (istanza, ultimo accesso), dalla meno recente
+        self._data: "OrderedDict[str, Tuple[MavkusAI, float]]" = OrderedDict()
+    
+    def get(self, user_id: str) -> Optional[MavkusAI]:
+        """Istanza dell'utente; l'accesso rinnova la scadenza"""
+        self.expire()
+        item = self._data.get(user_id)
+        if item is None:
+            return None
+        self._data[user_id] = (item[0], time.monotonic())
+        self._data.move_to_end(user_id)
+        return item[0]
+    
+    def peek(self, user_id: str) -> Optional[MavkusAI]:
+        """Istanza dell'utente senza rinnovarne la scadenza"""
+        self.expire()
+        item = self._data.get(user_id)
+        return item[0] if item else None
+    
+    def __setitem__(self, user_id: str, ai: MavkusAI):
+        self.pop(user_id)
+        self._data[user_id] = (ai, time.monotonic())
+        self.expire()
+        while len(self._data) > self.maxsize:
+            old_id, (old_ai, _) = self._data.popitem(last=False)
+            self._on_evict(old_id, old_ai)
+    
+    def pop(self, user_id: str) -> Optional[MavkusAI]:
+        """Rimuove l'istanza dell'utente"""
+        item = self._data.pop(user_id, None)
+        if item is None:
+            return None
+        self._on_evict(user_id, item[0])
+        return item[0]
+    
+    def expire(self):
+        """Rimuove le istanze inattive da più di ttl secondi"""
+        deadline = time.monotonic() - self.ttl
+        while self._data:
+            user_id, (ai, last_access) = next(iter(self._data.items()))
+            if last_access > deadline:
+                break
+            del self._data[user_id]
+            self._on_evict(user_id, ai)
+    
+    def clear(self):
+        """Rimuove tutte le istanze"""
+        while self._data:
+            user_id, (ai, _) = self._data.popitem(last=False)
+            self._on_evict(user_id, ai)
+
+async def _close_after(previous: Optional[asyncio.Task], ai: MavkusAI):
+    """Chiude l'istanza dopo l'eventuale chiusura precedente dello stesso utente"""
+    if previous:
+        await previous
+    await ai.aclose()
+
+def _release_ai(user_id: str, ai: MavkusAI):
+    """Salva e chiude un'istanza uscita dalla cache (dopo l'eventuale turno in corso)"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        ai.close()
+        return
+    
+    task = loop.create_task(_close_after(app.state.ai_closing.get(user_id), ai))
+    app.state.ai_closing[user_id] = task
+    
+    def _done(t: asyncio.Task):
+        if app.state.ai_closing.get(user_id) is t:
+            app.state.ai_closing.pop(user_id, None)
+    task.add_done_callback(_done)
+
+# Istanze AI per utente, salvate e chiuse quando escono dalla cache
+app.state.ai_cache = AIInstanceCache(AI_CACHE_SIZE, AI_CACHE_TTL, _release_ai)
+# Chiusure in corso per utente: una nuova istanza parte dalla memoria già salvata
+app.state.ai_closing = {}
+# Creazioni in corso per utente (single-flight): le richieste concorrenti
+# per lo stesso utente attendono lo stesso future
+app.state.ai_inflight = {}
+
+@app.on_event("shutdown")
+async def close_ai_instances():
+    """Salva e chiude tutte le istanze in cache"""
+    app.state.ai_cache.clear()
+    if app.state.ai_closing:
+        await asyncio.gather(*app.state.ai_closing.values())
+
+def _create_ai_instance(user_id: str, api_keys: Dict[str, str]) -> MavkusAI:
+    """Factory interna per istanze AI"""
     try:
-        # Recupera API keys da Firebase
-        api_keys = firebase_service.get_api_keys(user_id)
-        
         # Crea istanza
         ai = MavkusAI(
             user_id=user_id,
             groq_api_key=api_keys.get("groq_api_key"),
-            gemini_api_key=api_keys.get("gemini_api_key")
+            gemini_api_key=api_keys.get("gemini_api_key"),
+            http_client=getattr(app.state, "http", None)
         )
         
         logger.info(f"🤖 Istanza AI creata per: {user_id[:8]}...")
         return ai
         
     except Exception as e:
-        logger.error(f"❌ Errore creazione istanza AI: {e}")
+        logger.exception("❌ Errore creazione istanza AI", extra={"user_id": user_id})
         raise HTTPException(status_code=500, detail=str(e))
 
-def get_ai_instance(request: ChatRequest) -> MavkusAI:
-    """Dependency che estrae user_id dalla request"""
-    return _create_ai_instance(request.user_id)
+async def _build_ai(user_id: str) -> MavkusAI:
+    """Legge le chiavi, crea l'istanza fuori dall'event loop e la mette in cache"""
+    this_task = asyncio.current_task()
+    try:
+        # La memoria dell'istanza precedente deve essere su disco prima di ricaricarla
+        closing = app.state.ai_closing.get(user_id)
+        if closing:
+            await closing
+        
+        api_keys = await firebase_service.aget_api_keys(user_id)
+        ai = await asyncio.to_thread(_create_ai_instance, user_id, api_keys)
+        # Se nel frattempo l'utente è stato invalidato le chiavi lette sono vecchie:
+        # l'istanza serve solo a chi la stava aspettando, non va in cache
+        if app.state.ai_inflight.get(user_id) is this_task:
+            app.state.ai_cache[user_id] = ai
+        return ai
+    finally:
+        if app.state.ai_inflight.get(user_id) is this_task:
+            app.state.ai_inflight.pop(user_id, None)
+
+async def get_ai(user_id: str) -> MavkusAI:
+    """Istanza AI dell'utente, creata al primo uso"""
+    ai = app.state.ai_cache.get(user_id)
+    if ai is not None:
+        return ai
+    
+    task = app.state.ai_inflight.get(user_id)
+    if task is None:
+        task = asyncio.create_task(_build_ai(user_id))
+        app.state.ai_inflight[user_id] = task
+    # shield: se una richiesta viene annullata la creazione prosegue per le altre
+    return await asyncio.shield(task)
+
+def invalidate_ai_instance(user_id: str):
+    """Rimuove dalla cache l'istanza AI di un utente (e scarta la creazione in corso)"""
+    app.state.ai_cache.pop(user_id)
+    app.state.ai_inflight.pop(user_id, None)
+
+async def _get_ai_stats(user_id: str, create: bool = True) -> Dict[str, Any]:
+    """Stats aggiuntive dell'istanza AI ({} se non disponibile)"""
+    try:
+        if create:
+            ai = await get_ai(user_id)
+        else:
+            # Solo se già in cache: nessuna creazione né lettura chiavi
+            ai = app.state.ai_cache.peek(user_id)
+        return ai.get_stats() if ai else {}
+    except Exception:
+        return {}
+
+# =========================
+# BATCH WRITER CONVERSAZIONI
+# =========================
+BATCH_MAX_ITEMS = 400
+BATCH_FLUSH_INTERVAL = 0.025  # secondi
+
+_conversation_queue: asyncio.Queue = asyncio.Queue()
+_batch_writer_task: Optional[asyncio.Task] = None
+# Sentinella accodata allo shutdown: il writer finisce il blocco corrente ed esce
+_STOP_WRITER = object()
+
+def _drain_queue(limit: Optional[int] = None) -> Tuple[List[Tuple[str, str, Dict]], bool]:
+    """Svuota la coda senza attendere; indica se è arrivata la sentinella"""
+    items, stop = [], False
+    while not _conversation_queue.empty() and (limit is None or len(items) < limit):
+        item = _conversation_queue.get_nowait()
+        if item is _STOP_WRITER:
+            stop = True
+            continue
+        items.append(item)
+    return items, stop
+
+async def _next_batch() -> Tuple[List[Tuple[str, str, Dict]], bool]:
+    """Attende un salvataggio e raccoglie quelli arrivati nella finestra di flush"""
+    first = await _conversation_queue.get()
+    if first is _STOP_WRITER:
+        return [], True
+    
+    await asyncio.sleep(BATCH_FLUSH_INTERVAL)
+    items, stop = _drain_queue(BATCH_MAX_ITEMS - 1)
+    return [first] + items, stop
+
+async def _batch_writer():
+    """Scrive le conversazioni accodate con un WriteBatch per blocco"""
+    stop = False
+    while not stop:
+        items, stop = await _next_batch()
+        if not items:
+            continue
+        try:
+            await firebase_service.asave_conversations_batch(items)
+        except Exception:
+            # Il writer deve sopravvivere: un blocco perso non ferma i successivi
+            logger.exception("❌ Errore batch writer", extra={"conversations": len(items)})
+
+@app.on_event("startup")
+async def start_batch_writer():
+    global _batch_writer_task
+    _batch_writer_task = asyncio.create_task(_batch_writer())
+
+@app.on_event("shutdown")
+async def stop_batch_writer():
+    """Ferma il writer dopo il blocco in corso e salva quanto rimasto in coda"""
+    if _batch_writer_task:
+        _conversation_queue.put_nowait(_STOP_WRITER)
+        try:
+            await _batch_writer_task
+        except Exception:
+            # Anche se il writer è terminato con un errore la coda va svuotata
+            logger.exception("❌ Errore arresto batch writer")
+    
+    pending, _ = _drain_queue()
+    if pending:
+        await firebase_service.asave_conversations_batch(pending)
+
 # =========================
 # HEALTH & ROOT
 # =========================
@@ -96,7 +350,7 @@ async def root():
         "message": "MAVKUS AI API",
         "version": "3.0.0",
         "status": "operational",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now(timezone.utc).isoformat()
     }
 
 @app.get("/health")
@@ -105,7 +359,7 @@ async def health():
         "status": "healthy",
         "service": "mavkus-ai",
         "firebase": "connected" if firebase_service.available else "disconnected",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now(timezone.utc).isoformat()
     }
 
 # =========================
@@ -115,7 +369,7 @@ async def health():
 async def create_user_profile(request: UserProfileRequest):
     """Crea/aggiorna profilo utente"""
     try:
-        result = firebase_service.create_user_profile(
+        result = await firebase_service.acreate_user_profile(
             user_id=request.user_id,
             email=request.email,
             display_name=request.display_name,
@@ -134,7 +388,7 @@ async def create_user_profile(request: UserProfileRequest):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"❌ Errore create-profile: {e}")
+        logger.exception("❌ Errore create-profile", extra={"user_id": request.user_id})
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/auth/save-keys")
@@ -149,11 +403,11 @@ async def save_api_keys(request: SaveAPIKeysRequest):
             api_keys["gemini_api_key"] = request.gemini_api_key
         
         # Salva su Firebase
-        success = firebase_service.save_api_keys(request.user_id, api_keys)
+        success = await firebase_service.asave_api_keys(request.user_id, api_keys)
         
         if success:
             # Invalida cache per questo utente
-            get_ai_instance.cache_clear()
+            invalidate_ai_instance(request.user_id)
             
             return {
                 "success": True,
@@ -165,14 +419,14 @@ async def save_api_keys(request: SaveAPIKeysRequest):
             raise HTTPException(status_code=500, detail="Errore salvataggio Firebase")
             
     except Exception as e:
-        logger.error(f"❌ Errore save-keys: {e}")
+        logger.exception("❌ Errore save-keys", extra={"user_id": request.user_id})
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/auth/get-keys/{user_id}")
 async def get_api_keys(user_id: str):
     """Ottieni API keys utente"""
     try:
-        api_keys = firebase_service.get_api_keys(user_id)
+        api_keys = await firebase_service.aget_api_keys(user_id)
         
         return {
             "success": True,
@@ -182,23 +436,20 @@ async def get_api_keys(user_id: str):
         }
         
     except Exception as e:
-        logger.error(f"❌ Errore get-keys: {e}")
+        logger.exception("❌ Errore get-keys", extra={"user_id": user_id})
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/init")
 async def initialize_ai(request: InitRequest):
     """Inizializza MAVKUS per un utente"""
     try:
-        # Verifica che l'utente esista su Firebase
-        user_data = firebase_service.get_user(request.user_id)
+        # Verifica utente (le API keys le legge la factory dell'istanza)
+        user_data = await firebase_service.aget_user(request.user_id)
         if not user_data:
             raise HTTPException(status_code=404, detail="Utente non trovato")
         
-        # Recupera API keys salvate
-        api_keys = firebase_service.get_api_keys(request.user_id)
-        
-        # Ottieni o crea istanza AI (usa caching)
-        ai = _create_ai_instance(request.user_id) 
+        # Ottieni o crea istanza AI (usa caching, fuori dall'event loop)
+        ai = await get_ai(request.user_id)
         
         # Ottieni statistiche
         stats = ai.get_stats()
@@ -215,47 +466,50 @@ async def initialize_ai(request: InitRequest):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"❌ Errore init: {e}")
+        logger.exception("❌ Errore init", extra={"user_id": request.user_id})
         raise HTTPException(status_code=500, detail=str(e))
         
 @app.post("/api/chat")
 async def chat_with_ai(request: ChatRequest):
     """Chat con MAVKUS"""
+    msg = request.message
     try:
-        # 🔍 LOG DI DEBUG
-        logger.info(f"📥 Richiesta ricevuta:")
-        logger.info(f"  - user_id: {request.user_id} (type: {type(request.user_id)})")
-        logger.info(f"  - message: {request.message[:50]}...")
-        logger.info(f"  - enable_critique: {request.enable_critique}")
+        # 🔍 LOG DI DEBUG (formattato solo se il livello è attivo)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("chat uid=%s msg=%.50s critique=%s",
+                         request.user_id, msg, request.enable_critique)
         
         # Verifica input
-        if not request.message.strip():
+        if not msg.strip():
             raise HTTPException(status_code=400, detail="Messaggio vuoto")
         
         # Ottieni istanza AI
-        ai = _create_ai_instance(request.user_id)
+        ai = await get_ai(request.user_id)
         
-        logger.info(f"💬 Chat da {request.user_id[:8]}: {request.message[:50]}...")
+        logger.info("💬 Chat da %.8s: %.50s...", request.user_id, msg)
         
-        # Processa messaggio
-        response, metadata = ai.chat(
-            request.message,
+        # Processa messaggio (chiamate Groq/Gemini async)
+        response, metadata = await ai.achat(
+            msg,
             enable_critique=request.enable_critique
         )
         
-        # Salva conversazione su Firebase
+        # Un solo timestamp per messaggi e risposta
+        now_iso = datetime.now(timezone.utc).isoformat()
+        
+        # Conversazione da salvare su Firebase
         conversation_data = {
-            "title": request.message[:50] + ("..." if len(request.message) > 50 else ""),
+            "title": msg[:50] + ("..." if len(msg) > 50 else ""),
             "messages": [
                 {
                     "role": "user",
-                    "content": request.message,
-                    "timestamp": datetime.now().isoformat()
+                    "content": msg,
+                    "timestamp": now_iso
                 },
                 {
                     "role": "assistant",
                     "content": response,
-                    "timestamp": datetime.now().isoformat(),
+                    "timestamp": now_iso,
                     "metadata": metadata
                 }
             ],
@@ -263,7 +517,10 @@ async def chat_with_ai(request: ChatRequest):
             "message_count": 2
         }
         
-        conversation_id = firebase_service.save_conversation(request.user_id, conversation_data)
+        # Id generato subito, scrittura a blocchi dal batch writer
+        conversation_id = firebase_service.new_conversation_id(request.user_id)
+        if conversation_id:
+            _conversation_queue.put_nowait((request.user_id, conversation_id, conversation_data))
         
         # Risposta
         return {
@@ -276,19 +533,19 @@ async def chat_with_ai(request: ChatRequest):
                 "gemini_used": metadata.get("gemini_used", False),
                 "has_critique": bool(metadata.get("critique"))
             },
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now_iso
         }
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"❌ Errore chat: {e}")
+        logger.exception("❌ Errore chat", extra={"user_id": request.user_id})
         raise HTTPException(status_code=500, detail=str(e))
 @app.get("/api/conversations/{user_id}")
 async def get_user_conversations(user_id: str, limit: int = 20):
     """Ottieni conversazioni utente"""
     try:
-        conversations = firebase_service.get_conversations(user_id, limit)
+        conversations = await firebase_service.aget_conversations(user_id, limit)
         
         return {
             "success": True,
@@ -298,14 +555,35 @@ async def get_user_conversations(user_id: str, limit: int = 20):
         }
         
     except Exception as e:
-        logger.error(f"❌ Errore get-conversations: {e}")
+        logger.exception("❌ Errore get-conversations", extra={"user_id": user_id})
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/conversations/{user_id}/{conversation_id}")
+async def get_user_conversation(user_id: str, conversation_id: str):
+    """Ottieni una conversazione completa"""
+    try:
+        conversation = await firebase_service.aget_conversation_full(user_id, conversation_id)
+        
+        if not conversation:
+            raise HTTPException(status_code=404, detail="Conversazione non trovata")
+        
+        return {
+            "success": True,
+            "user_id": user_id,
+            "conversation": conversation
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("❌ Errore get-conversation", extra={"user_id": user_id})
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/api/conversations/{user_id}/{conversation_id}")
 async def delete_conversation(user_id: str, conversation_id: str):
     """Elimina conversazione"""
     try:
-        success = firebase_service.delete_conversation(user_id, conversation_id)
+        success = await firebase_service.adelete_conversation(user_id, conversation_id)
         
         if success:
             return {
@@ -318,42 +596,44 @@ async def delete_conversation(user_id: str, conversation_id: str):
             raise HTTPException(status_code=500, detail="Errore eliminazione")
             
     except Exception as e:
-        logger.error(f"❌ Errore delete-conversation: {e}")
+        logger.exception("❌ Errore delete-conversation", extra={"user_id": user_id})
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/stats/{user_id}")
-async def get_user_stats(user_id: str):
-    """Ottieni statistiche utente"""
+async def get_user_stats(user_id: str, include_ai: bool = False):
+    """Ottieni statistiche utente (include_ai=true crea l'istanza AI se serve)"""
     try:
-        # Ottieni dati da Firebase
-        user_data = firebase_service.get_user(user_id)
+        # Profilo e shard del contatore in parallelo
+        user_data, shard_conversations = await asyncio.gather(
+            firebase_service.aget_user(user_id),
+            firebase_service.aget_conversation_count(user_id)
+        )
         
         if not user_data:
             raise HTTPException(status_code=404, detail="Utente non trovato")
         
-        # Ottieni istanza AI per stats aggiuntive
-        try:
-            ai = _create_ai_instance(user_id)
-            ai_stats = ai.get_stats()
-        except:
-            ai_stats = {}
+        # Stats AI solo per utenti esistenti (include_ai può creare l'istanza)
+        ai_stats = await _get_ai_stats(user_id, create=include_ai)
+        
+        # Valore storico sul profilo + somma degli shard
+        total_conversations = user_data.get("total_conversations", 0) + shard_conversations
         
         return {
             "success": True,
             "user_id": user_id,
             "firebase_data": {
-                "total_conversations": user_data.get("total_conversations", 0),
+                "total_conversations": total_conversations,
                 "total_tokens_used": user_data.get("total_tokens_used", 0),
                 "created_at": user_data.get("created_at"),
                 "last_login": user_data.get("last_login"),
                 "api_keys_configured": user_data.get("api_keys_configured", False)
             },
             "ai_stats": ai_stats,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": datetime.now(timezone.utc).isoformat()
         }
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"❌ Errore stats: {e}")
+        logger.exception("❌ Errore stats", extra={"user_id": user_id})
         raise HTTPException(status_code=500, detail=str(e))